@@ -1,6 +1,11 @@
+import os
+import copy
+import random
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import onnx 
 
 # --- Board Dimensions & NN Configuration ---
@@ -12,6 +17,23 @@ NUM_INPUT_CHANNELS = 37
 POLICY_OUTPUT_SIZE = 4096 
 VALUE_OUTPUT_SIZE = 4     
 
+# Traced batch for ONNX export (and the default for static exports). A mid-range default,
+# not the engine's batch: self-play evaluates up to --nn-batch (1024), the strength test
+# defaults to 64 and inference mode to 16. Dynamic exports accept any batch size.
+DEFAULT_TRACE_BATCH = 64
+
+# Self-play shard format (gen_*.bin, written by data_writer.h): consecutive FP32 records.
+# Mapping a shard with this dtype gives already-shaped field views of each block.
+SAMPLE_DTYPE = np.dtype([
+    ('state', '<f4', (NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM)),
+    ('policy', '<f4', (POLICY_OUTPUT_SIZE,)),
+    ('value', '<f4', (VALUE_OUTPUT_SIZE,)),
+])
+SAMPLE_SIZE_BYTES = SAMPLE_DTYPE.itemsize
+
+# Only the N newest shards feed the replay buffer (and INT8 calibration)
+REPLAY_WINDOW_FILES = 50
+
 # Network Architecture
 NUM_RES_BLOCKS = 4
 NUM_CHANNELS = 64
@@ -32,7 +54,7 @@ class ResBlock(nn.Module):
         residual = x
         out = F.relu(self.bn1(self.conv1(x)))
         out = self.bn2(self.conv2(out))
-        out += residual
+        out = out + residual
         out = F.relu(out)
         return out
 
@@ -82,6 +104,54 @@ class ChaturajiNN(nn.Module):
 
         return p, v
 
+def fuse_conv_bn(model):
+    """
+    Folds every BatchNorm2d into the Conv2d that feeds it (inference only).
+    The BN modules are replaced with nn.Identity(), so forward() is unchanged.
+    Safe to call on an already fused model.
+    """
+    def _fuse(parent, conv_name, bn_name):
+        conv = getattr(parent, conv_name)
+        bn = getattr(parent, bn_name)
+        if not isinstance(bn, nn.BatchNorm2d):
+            return
+        setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+        setattr(parent, bn_name, nn.Identity())
+
+    model.eval()
+    _fuse(model, 'conv1', 'bn1')
+    for block in model.resblocks:
+        _fuse(block, 'conv1', 'bn1')
+        _fuse(block, 'conv2', 'bn2')
+    _fuse(model, 'policy_conv', 'policy_bn')
+    _fuse(model, 'value_conv', 'value_bn')
+    return model
+
+def simplify_onnx(model_path):
+    """
+    Runs onnx-simplifier and shape inference over an exported model in place.
+    Folds leftover shape arithmetic and annotates static intermediate shapes.
+    """
+    # Both steps are optional polish: on any failure the exported graph is kept as is
+    model = onnx.load(model_path)
+    try:
+        import onnxsim
+        simplified, ok = onnxsim.simplify(model)
+        if ok:
+            model = simplified
+        else:
+            print("[Python] Warning: onnxsim could not validate the simplified model. Keeping original.")
+    except ImportError:
+        print("[Python] onnxsim not installed. Skipping graph simplification.")
+    except Exception as e:
+        print(f"[Python] Warning: onnxsim failed ({e}). Keeping original.")
+
+    try:
+        model = onnx.shape_inference.infer_shapes(model)
+    except Exception as e:
+        print(f"[Python] Warning: ONNX shape inference failed ({e}). Saving without it.")
+    onnx.save(model, model_path)
+
 def force_patch_onnx_batch_size(model_path):
     """
     Manually overrides input/output dimensions to 'batch_size'.
@@ -100,26 +170,34 @@ def force_patch_onnx_batch_size(model_path):
     except Exception as e:
         print(f"[Python] Warning: Failed to patch ONNX dimensions: {e}")
 
-def export_to_onnx(model_path, output_path):
-    print(f"Exporting ONNX: Loading weights from {model_path}...")
-    
-    if hasattr(torch, 'xpu') and torch.xpu.is_available():
-        device = torch.device("xpu")
-    elif torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
-
-    model = ChaturajiNN().to(device)
+def convert_onnx_to_fp16(model_path):
+    """
+    Converts the weights and body of an exported ONNX model to FP16 in place.
+    Graph inputs/outputs stay FP32, so the C++ engine feeds and reads floats as before.
+    """
     try:
-        model.load_state_dict(torch.load(model_path, map_location=device))
-    except FileNotFoundError:
-        print("Warning: Model weights not found. Exporting random init.")
+        from onnxconverter_common import float16
+    except ImportError:
+        print("[Python] Warning: onnxconverter-common not installed. Keeping FP32 model.")
+        return
+
+    model = onnx.load(model_path)
+    model = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model, model_path)
+    print(f"[Python] Converted {model_path} to FP16 (FP32 inputs/outputs kept)")
+
+def _onnx_export(model, output_path, fp16=False, trace_batch=DEFAULT_TRACE_BATCH, dynamic=True):
+    """
+    Single export path shared by every CLI command and by train.py.
+    Fuses BN, traces, simplifies, patches the batch dim and optionally converts to FP16.
+    """
     model.eval()
+    fuse_conv_bn(model)
+    device = next(model.parameters()).device
 
-    # Use a dummy batch size of 1. 
-    # Because we use flatten(1) and dynamic_axes, this should not stick.
-    dummy_input = torch.randn(1, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM).to(device)
+    # Trace at trace_batch. With dynamic=True the batch dim stays symbolic
+    # (flatten(1) + dynamic_axes); with dynamic=False the graph is fixed to trace_batch.
+    dummy_input = torch.randn(trace_batch, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM).to(device)
 
     # 1. Prepare Arguments
     export_args = {
@@ -128,66 +206,235 @@ def export_to_onnx(model_path, output_path):
         "f": output_path,
         "export_params": True,
         "opset_version": 18,        # Use 18 as requested by logs
-        "do_constant_folding": False, # Ensure dynamic calc of shapes if needed
+        "do_constant_folding": True,  # Safe now that flatten(1) keeps the batch dim symbolic
         "input_names": ['input'],
         "output_names": ['policy', 'value'],
         "dynamic_axes": {
             'input': {0: 'batch_size'},
             'policy': {0: 'batch_size'},
             'value': {0: 'batch_size'}
-        }
+        } if dynamic else None
     }
 
     # 2. Attempt to force legacy exporter via kwarg if supported
-    # Recent PyTorch versions introduced 'dynamo' arg to toggle the new exporter
+    # Recent PyTorch versions introduced 'dynamo' arg to toggle the new exporter.
+    # inference_mode skips autograd bookkeeping during the trace run.
+    with torch.inference_mode():
+        try:
+            torch.onnx.export(**export_args, dynamo=False)
+            print("[Python] Exported using Legacy Exporter (dynamo=False).")
+        except TypeError:
+            # Fallback for versions where 'dynamo' arg doesn't exist
+            print("[Python] 'dynamo' arg not supported, calling standard export.")
+            torch.onnx.export(**export_args)
+
+    # 3. Simplify, then apply Patch
+    simplify_onnx(output_path)
+    if dynamic:
+        force_patch_onnx_batch_size(output_path)
+
+    # 4. Optional FP16 conversion (after patching, so the batch dim stays symbolic)
+    if fp16:
+        convert_onnx_to_fp16(output_path)
+
+def export_to_onnx(model_path, output_path, fp16=False, trace_batch=DEFAULT_TRACE_BATCH, dynamic=True):
+    print(f"Exporting ONNX: Loading weights from {model_path}...")
+    
+    if hasattr(torch, 'xpu') and torch.xpu.is_available():
+        device = torch.device("xpu")
+    elif torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    model = ChaturajiNN().to(device)
     try:
-        torch.onnx.export(**export_args, dynamo=False)
-        print("[Python] Exported using Legacy Exporter (dynamo=False).")
-    except TypeError:
-        # Fallback for versions where 'dynamo' arg doesn't exist
-        print("[Python] 'dynamo' arg not supported, calling standard export.")
-        torch.onnx.export(**export_args)
-
-    # 3. Apply Patch
-    force_patch_onnx_batch_size(output_path)
+        model.load_state_dict(torch.load(model_path, map_location=device))
+    except FileNotFoundError:
+        print("Warning: Model weights not found. Exporting random init.")
+
+    _onnx_export(model, output_path, fp16=fp16, trace_batch=trace_batch, dynamic=dynamic)
+    print(f"Successfully exported ONNX model to {output_path}")
+
+def export_model_to_onnx(model, output_path, fp16=False, trace_batch=DEFAULT_TRACE_BATCH, dynamic=True):
+    # Exports an in-memory model without the save/reload round trip. Works on a copy,
+    # since exporting switches to eval mode and folds BN into the convs.
+    _onnx_export(copy.deepcopy(model), output_path, fp16=fp16, trace_batch=trace_batch, dynamic=dynamic)
     print(f"Successfully exported ONNX model to {output_path}")
 
+def export_static_onnx(model_path, output_path, batch_sizes=(DEFAULT_TRACE_BATCH,), fp16=False):
+    """
+    Exports one fixed-shape ONNX model per batch size (<name>_b<N>.onnx), for
+    TensorRT-style deployments that build fully shape-specialized engines, e.g.
+    trtexec --onnx=model_b64.onnx --fp16 --saveEngine=model_b64.plan
+    """
+    base = os.path.splitext(output_path)[0]
+    paths = []
+    for batch in batch_sizes:
+        path = f"{base}_b{batch}.onnx"
+        export_to_onnx(model_path, path, fp16=fp16, trace_batch=batch, dynamic=False)
+        paths.append(path)
+    return paths
+
+def optimize_onnx_offline(model_path, output_path=None):
+    """
+    Offline inspection/benchmark tool: runs ONNX Runtime's graph optimizer once and
+    saves the fused graph (Conv+Relu -> FusedConv, Gemm+Relu -> FusedGemm).
+    Writes <name>.opt.onnx next to the input unless output_path is given.
+    The engine does not load this file: model.cpp runs latest.onnx on the OpenVINO
+    EP, which cannot execute the com.microsoft fused ops this graph contains.
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("[Python] Error: onnxruntime is required for offline graph optimization.")
+        return None
+
+    if output_path is None:
+        output_path = os.path.splitext(model_path)[0] + ".opt.onnx"
+
+    # EXTENDED rather than ALL: ALL also adds NCHWc layout transforms tied to the
+    # exporting CPU. The EXTENDED output is still CPU-EP-only (FusedConv/FusedGemm).
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_options.optimized_model_filepath = output_path
+    ort.InferenceSession(model_path, sess_options, providers=['CPUExecutionProvider'])
+
+    print(f"[Python] Saved ORT-optimized graph to {output_path}")
+    return output_path
+
+def list_recent_shards(data_dir, window=REPLAY_WINDOW_FILES):
+    """
+    Returns (path, num_records) for the non-empty shards among the `window` newest
+    gen_*.bin files, newest first. A single scandir pass; each entry's stat is cached.
+    """
+    entries = []
+    if os.path.isdir(data_dir):
+        with os.scandir(data_dir) as it:
+            for e in it:
+                if e.name.startswith("gen_") and e.name.endswith(".bin"):
+                    st = e.stat()
+                    entries.append((st.st_mtime, e.path, st.st_size // SAMPLE_SIZE_BYTES))
+    entries.sort(reverse=True)
+    # Window first, then drop empty files, so empty files still count toward the window
+    return [(path, n) for _, path, n in entries[:window] if n > 0]
+
+def _load_calibration_states(data_dir, num_samples):
+    """
+    Draws up to num_samples real board tensors from the replay window's gen_*.bin files,
+    spread evenly across them. Returns an empty list if no data is available.
+    """
+    shards = list_recent_shards(data_dir)
+
+    states = []
+    for i, (fp, n) in enumerate(shards):
+        # Even share of what is still needed; short shards pass their remainder on
+        quota = -(-(num_samples - len(states)) // (len(shards) - i))
+        take = min(n, quota)
+
+        data = np.memmap(fp, dtype=SAMPLE_DTYPE, mode='r', shape=(n,))
+        for j in sorted(random.sample(range(n), take)):
+            states.append(np.array(data[j]['state'])[None])
+        del data
+    return states
+
+def export_int8_onnx(model_path, output_path, data_dir="training_data", num_calib=256):
+    """
+    Exports a BN-fused FP32 ONNX model and statically quantizes it to INT8 (QDQ, per-channel).
+    Activation ranges are calibrated (MinMax) on real self-play positions from data_dir,
+    falling back to synthetic boards when none are available.
+    """
+    try:
+        from onnxruntime.quantization import (
+            quantize_static, CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType
+        )
+    except ImportError:
+        print("[Python] Error: onnxruntime is required for INT8 export.")
+        return
+
+    calib_states = _load_calibration_states(data_dir, num_calib)
+    if calib_states:
+        print(f"[Python] Calibrating INT8 on {len(calib_states)} positions from {data_dir}")
+    else:
+        print("[Python] No self-play data found. Calibrating INT8 on synthetic boards.")
+        # Board planes are mostly 0/1 indicators; mimic that sparsity
+        calib_states = [
+            (torch.rand(1, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM) < 0.1).float().numpy()
+            for _ in range(num_calib)
+        ]
+
+    class BoardCalibrationReader(CalibrationDataReader):
+        def __init__(self, states):
+            self.samples = iter([{'input': st} for st in states])
+
+        def get_next(self):
+            return next(self.samples, None)
+
+    fp32_path = output_path + ".fp32"
+    export_to_onnx(model_path, fp32_path)
+
+    quantize_static(
+        fp32_path, output_path, BoardCalibrationReader(calib_states),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+    os.remove(fp32_path)
+    print(f"[Python] Exported INT8 ONNX model to {output_path}")
+
 if __name__ == "__main__":
     import sys
+
+    def positive_int_or_exit(value, what):
+        if not value.isdigit() or int(value) < 1:
+            print(f"[Python] Error: {what} must be a positive integer, got '{value}'")
+            sys.exit(1)
+        return int(value)
     
-    if len(sys.argv) > 1:
-        cmd = sys.argv[1]
+    # Optional flags may appear anywhere; the rest are positional.
+    fp16 = False
+    trace_batch = DEFAULT_TRACE_BATCH
+    argv = []
+    arg_iter = iter(sys.argv)
+    for arg in arg_iter:
+        if arg == "--fp16":
+            fp16 = True
+        elif arg == "--trace-batch":
+            trace_batch = positive_int_or_exit(next(arg_iter, ""), "--trace-batch")
+        else:
+            argv.append(arg)
+
+    if len(argv) > 1:
+        cmd = argv[1]
         
         if cmd == "export":
-            input_pth = sys.argv[2] if len(sys.argv) > 2 else "model.pth"
-            output_onnx = sys.argv[3] if len(sys.argv) > 3 else "model.onnx"
-            export_to_onnx(input_pth, output_onnx)
+            input_pth = argv[2] if len(argv) > 2 else "model.pth"
+            output_onnx = argv[3] if len(argv) > 3 else "model.onnx"
+            export_to_onnx(input_pth, output_onnx, fp16=fp16, trace_batch=trace_batch)
+
+        elif cmd == "export_static":
+            # Fixed-shape graphs, one per batch size (comma list, default: --trace-batch)
+            input_pth = argv[2] if len(argv) > 2 else "model.pth"
+            output_onnx = argv[3] if len(argv) > 3 else "model.onnx"
+            batch_sizes = [positive_int_or_exit(b, "Each export_static batch size") for b in argv[4].split(",")] if len(argv) > 4 else [trace_batch]
+            export_static_onnx(input_pth, output_onnx, batch_sizes, fp16=fp16)
+
+        elif cmd == "optimize":
+            input_onnx = argv[2] if len(argv) > 2 else "model.onnx"
+            output_onnx = argv[3] if len(argv) > 3 else None
+            optimize_onnx_offline(input_onnx, output_onnx)
+
+        elif cmd == "export_int8":
+            input_pth = argv[2] if len(argv) > 2 else "model.pth"
+            output_onnx = argv[3] if len(argv) > 3 else "model_int8.onnx"
+            data_dir = argv[4] if len(argv) > 4 else "training_data"
+            export_int8_onnx(input_pth, output_onnx, data_dir)
             
         elif cmd == "export_random":
-            output_onnx = sys.argv[2] if len(sys.argv) > 2 else "initial_random.onnx"
+            output_onnx = argv[2] if len(argv) > 2 else "initial_random.onnx"
             print(f"Exporting random initialized model to {output_onnx}...")
             
-            # Re-use logic for random export
-            model = ChaturajiNN()
-            model.eval()
-            dummy_input = torch.randn(1, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM)
-            
-            export_args = {
-                "model": model,
-                "args": dummy_input,
-                "f": output_onnx,
-                "export_params": True,
-                "opset_version": 18,
-                "do_constant_folding": False,
-                "input_names": ['input'],
-                "output_names": ['policy', 'value'],
-                "dynamic_axes": {'input': {0: 'batch_size'}, 'policy': {0: 'batch_size'}, 'value': {0: 'batch_size'}}
-            }
-            
-            try:
-                torch.onnx.export(**export_args, dynamo=False)
-            except TypeError:
-                torch.onnx.export(**export_args)
-                
-            force_patch_onnx_batch_size(output_onnx)
+            _onnx_export(ChaturajiNN(), output_onnx, fp16=fp16, trace_batch=trace_batch)
             print("Done.")
\ No newline at end of file
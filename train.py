@@ -1,83 +1,251 @@
+# Requires PyTorch >= 2.3 (torch.amp.GradScaler(device), torch.load(mmap=True), dtype.itemsize)
 import random
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-import struct
 import os
-import glob
 import argparse
 import sys
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from model import (
-    ChaturajiNN, export_to_onnx,
-    NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_AREA,
-    POLICY_OUTPUT_SIZE, VALUE_OUTPUT_SIZE
+    ChaturajiNN, export_model_to_onnx, list_recent_shards,
+    NUM_INPUT_CHANNELS, BOARD_DIM, POLICY_OUTPUT_SIZE, VALUE_OUTPUT_SIZE,
+    SAMPLE_DTYPE, REPLAY_WINDOW_FILES
 )
 
-# Constants for binary data parsing
-INPUT_SIZE = NUM_INPUT_CHANNELS * BOARD_AREA
+# Constants for binary data parsing (the record layout itself is SAMPLE_DTYPE in model.py)
 POLICY_SIZE = POLICY_OUTPUT_SIZE
 VALUE_SIZE = VALUE_OUTPUT_SIZE
-SAMPLE_SIZE_BYTES = (INPUT_SIZE + POLICY_SIZE + VALUE_SIZE) * 4
+
+# Shards are mapped and copied in parallel to overlap page faults and disk reads across
+# files. Kept small: each index_copy_ is already multi-threaded, so more workers mostly
+# add contention and temporaries.
+LOAD_WORKERS = 4
+# Rows converted per index_copy_, so each worker's FP16 temporary stays bounded
+# (~34 MB for the policy block) no matter how large a shard is
+LOAD_CHUNK_ROWS = 4096
+
+# Rows permuted at a time when a run wraps around the buffer; bounds the reshuffle's
+# temporary to ~134 MB (policy block) instead of a second copy of the whole buffer
+RESHUFFLE_CHUNK_ROWS = 16384
+
+# Default steps between loss reports (--log-interval). Losses are averaged on-device in
+# between, so the GPU is only synchronized once per interval
+LOG_INTERVAL = 50
+
+# In-RAM dtype for board planes and policy targets. Planes are 0/1 indicators plus a few
+# small scalars (points/100, 50-move clock), all well within FP16 precision; this halves
+# buffer RAM and host->device traffic. Value targets stay FP32.
+BUFFER_DTYPE = torch.float16
 
 class ReplayBuffer:
-    def __init__(self, data_dir, max_size, window_size_files=50):
+    def __init__(self, data_dir, max_size, window_size_files=REPLAY_WINDOW_FILES):
         self.data_dir = data_dir
         self.max_size = max_size
         self.window_size_files = window_size_files # Number of recent files to look at
         self.states = torch.empty(0)
         self.policies = torch.empty(0)
         self.values = torch.empty(0)
+        self._cursor = 0 # Next unread row of the shuffled buffer
         self.load_buffer()
 
     def load_buffer(self):
-        files = glob.glob(os.path.join(self.data_dir, "gen_*.bin"))
-        # 1. Sort by time (newest first)
-        files.sort(key=os.path.getmtime, reverse=True)
-        
-        # 2. Define the "Disk Window": Keep only the N most recent files
-        if len(files) > self.window_size_files:
-            files = files[:self.window_size_files]
+        # 1-2. The "Disk Window": the N most recent files (newest first)
+        files = list_recent_shards(self.data_dir, self.window_size_files)
             
         # 3. Shuffle the "Window": This decouples RAM Buffer from strict recency
         random.shuffle(files)
         
-        t_s, t_p, t_v = [], [], []
+        # 4. Size the buffer up front so every shard is copied straight into its final
+        # slot (no per-file tensors, no torch.cat doubling peak RAM)
+        shards = []
         total = 0
-        
-        for fp in files:
+        for fp, n in files:
             if total >= self.max_size: break
             
-            file_size = os.path.getsize(fp)
-            n = file_size // SAMPLE_SIZE_BYTES
-            
-            if n == 0: continue
-            
-            with open(fp, "rb") as f:
-                content = f.read()
-            
-            data = np.frombuffer(content, dtype=np.float32).reshape(n, -1)
-            
-            t_s.append(torch.from_numpy(data[:, :INPUT_SIZE].copy()).view(n, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM))
-            t_p.append(torch.from_numpy(data[:, INPUT_SIZE : INPUT_SIZE + POLICY_SIZE].copy()))
-            t_v.append(torch.from_numpy(data[:, INPUT_SIZE + POLICY_SIZE :].copy()))
-            
-            total += n
-            
-            # Explicitly delete raw content to free RAM immediately for the next iteration
-            del content
-            del data
+            take = min(n, self.max_size - total)
+            shards.append((fp, n, take))
+            total += take
+
+        if total == 0: return
+
+        self.states = torch.empty((total, NUM_INPUT_CHANNELS, BOARD_DIM, BOARD_DIM), dtype=BUFFER_DTYPE)
+        self.policies = torch.empty((total, POLICY_SIZE), dtype=BUFFER_DTYPE)
+        self.values = torch.empty((total, VALUE_SIZE), dtype=torch.float32)
+
+        # 5. Scatter rows to random slots while copying, so the buffer is already shuffled
+        # and sample_batch can serve contiguous slices
+        perm = torch.randperm(total)
+        jobs = []
+        offset = 0
+        for fp, n, take in shards:
+            jobs.append((fp, n, take, perm[offset : offset + take]))
+            offset += take
+
+        # 6. Shards own disjoint slots, so workers write into the slabs concurrently
+        with ThreadPoolExecutor(max_workers=min(LOAD_WORKERS, len(jobs))) as ex:
+            for fut in [ex.submit(self._load_shard, *job) for job in jobs]:
+                fut.result() # Re-raise any worker error
+
+        print(f"[Python] Replay Buffer: Loaded {total} samples from a window of {len(files)} files.")
+
+    def _load_shard(self, fp, n, take, slots):
+        # Map the shard instead of reading it: the page cache backs the data, so the only
+        # temporaries are the per-chunk FP16 conversions. mode='c' (copy-on-write) gives
+        # torch a writable view without ever touching the file.
+        data = np.memmap(fp, dtype=SAMPLE_DTYPE, mode='c', shape=(n,))[:take]
+        
+        for i in range(0, take, LOAD_CHUNK_ROWS):
+            chunk = data[i : i + LOAD_CHUNK_ROWS]
+            rows = slots[i : i + LOAD_CHUNK_ROWS]
+            self.states.index_copy_(0, rows, torch.from_numpy(chunk['state']).to(BUFFER_DTYPE))
+            self.policies.index_copy_(0, rows, torch.from_numpy(chunk['policy']).to(BUFFER_DTYPE))
+            self.values.index_copy_(0, rows, torch.from_numpy(chunk['value']))
+
+    def to(self, device):
+        # Moves the whole buffer into device memory; batches become on-device slices
+        # with no per-step H2D copy
+        self.states = self.states.to(device)
+        self.policies = self.policies.to(device)
+        self.values = self.values.to(device)
+        return self
 
-        if total > 0:
-            self.states = torch.cat(t_s)[:self.max_size]
-            self.policies = torch.cat(t_p)[:self.max_size]
-            self.values = torch.cat(t_v)[:self.max_size]
-            print(f"[Python] Replay Buffer: Loaded {self.states.size(0)} samples from a window of {len(files)} files.")
+    def _reshuffle(self):
+        # Only reached when one run trains past a full pass over the buffer. Rows were
+        # globally shuffled at load time, so permuting in place within large blocks is
+        # enough to give the next pass fresh batch compositions, without a gathered
+        # copy of the whole buffer (on the GPU too, with --gpu-buffer).
+        total = self.states.size(0)
+        for start in range(0, total, RESHUFFLE_CHUNK_ROWS):
+            end = min(start + RESHUFFLE_CHUNK_ROWS, total)
+            perm = torch.randperm(end - start, device=self.states.device)
+            for t in (self.states, self.policies, self.values):
+                t[start:end] = t[start:end][perm]
+        self._cursor = 0
 
+    @torch.no_grad()
     def sample_batch(self, batch_size):
-        idx = torch.randint(0, self.states.size(0), (batch_size,))
-        return self.states[idx], self.policies[idx], self.values[idx]
+        # Rows are stored in random order, so consecutive slices are random batches:
+        # sequential reads instead of a scattered gather across the whole buffer
+        if self._cursor + batch_size > self.states.size(0):
+            self._reshuffle()
+        start, end = self._cursor, self._cursor + batch_size
+        self._cursor = end
+
+        return self.states[start:end], self.policies[start:end], self.values[start:end]
+
+def pack_batch(batch):
+    """
+    Copies the batch tensors back to back into one page-locked byte buffer, so the
+    whole batch moves to the device with a single async H2D copy.
+    """
+    nbytes = [t.numel() * t.element_size() for t in batch]
+    flat = torch.empty(sum(nbytes), dtype=torch.uint8, pin_memory=True)
+    offset = 0
+    for t, n in zip(batch, nbytes):
+        flat[offset : offset + n].view(t.dtype).view(t.shape).copy_(t)
+        offset += n
+    return flat, [(t.dtype, t.shape) for t in batch]
+
+def unpack_batch(flat, specs):
+    # Typed views into the packed buffer; offsets stay aligned since every block is
+    # a multiple of 4 bytes
+    batch = []
+    offset = 0
+    for dtype, shape in specs:
+        n = shape.numel() * dtype.itemsize
+        batch.append(flat[offset : offset + n].view(dtype).view(shape))
+        offset += n
+    return tuple(batch)
+
+class BatchPrefetcher:
+    """
+    Samples upcoming batches on a background thread and starts their H2D copies
+    (on a side CUDA stream when available) while the current step is running.
+    """
+    def __init__(self, buffer, batch_size, num_batches, device, depth=2):
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.copy_stream = torch.cuda.Stream(device) if self.use_cuda else None
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(
+            target=self._produce, args=(buffer, batch_size, num_batches), daemon=True)
+        self.thread.start()
+
+    # Grad mode is thread-local; no_grad (not inference_mode, whose tensors cannot be
+    # saved for backward by the loss) keeps autograd out of the producer thread
+    @torch.no_grad()
+    def _produce(self, buffer, batch_size, num_batches):
+        try:
+            for _ in range(num_batches):
+                batch = buffer.sample_batch(batch_size)
+                event = None
+                if self.use_cuda:
+                    # One pinned buffer -> one async H2D copy per batch
+                    flat, specs = pack_batch(batch)
+                    with torch.cuda.stream(self.copy_stream):
+                        batch = unpack_batch(flat.to(self.device, non_blocking=True), specs)
+                        event = torch.cuda.Event()
+                        event.record(self.copy_stream)
+                else:
+                    # Always copy: on CPU .to() would return views into the buffer, which
+                    # _reshuffle may permute in place while the batch is still queued
+                    batch = tuple(t.to(self.device, copy=True) for t in batch)
+                self.queue.put((batch, event))
+        except Exception as e:
+            self.queue.put((e, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, event = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            # Make the compute stream wait for the copy, and tell the caching allocator
+            # the tensors are now in use there
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(event)
+            for t in batch:
+                t.record_stream(compute_stream)
+        return batch
+
+def compute_loss(p, v, tp, tv):
+    # Explicit loss components. cross_entropy with probability targets is the same
+    # -sum(tp * log_softmax(p)) / batch, computed by one ATen op instead of three
+    loss_policy = F.cross_entropy(p, tp)
+    loss_value = F.mse_loss(v, tv)
+    return loss_policy + loss_value, loss_policy, loss_value
+
+def load_checkpoint(path, mmap=False):
+    # With mmap the file is mapped instead of read into RAM. Only safe when the caller copies
+    # the tensors out, since the checkpoint is overwritten in place at the end of training.
+    return torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+
+def has_native_bf16(device):
+    # Hardware BF16 only; is_bf16_supported() also reports True for emulated BF16, which
+    # is slower than FP16 autocast on pre-Ampere GPUs
+    if device.type == "cuda":
+        return bool(torch.version.hip) or torch.cuda.get_device_properties(device).major >= 8
+    if device.type == "xpu":
+        return getattr(torch.xpu.get_device_properties(device), "has_bfloat16_conversions", False)
+    return False
+
+def resolve_amp_dtype(device, amp):
+    # Autocast only pays off on accelerators; CPU runs stay in FP32
+    if amp == "none" or device.type not in ("cuda", "xpu"):
+        return None
+    if amp == "bf16":
+        if not has_native_bf16(device):
+            print("[Python] No native BF16 on this device. Falling back to FP16 autocast.")
+            return torch.float16
+        return torch.bfloat16
+    return torch.float16
 
 def train_loop(args):
     if hasattr(torch, 'xpu') and torch.xpu.is_available():
@@ -97,6 +265,10 @@ def train_loop(args):
 
     # 1. Model & Optimizer Setup
     model = ChaturajiNN().to(device)
+    # NHWC conv kernels (Tensor Core friendly) on accelerators; params keep their identity
+    channels_last = device.type in ("cuda", "xpu")
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
     # Lc0 and AlphaZero use SGD with Momentum=0.9
     optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.wd)
     print(f"[Python] Optimizer: SGD (lr={args.lr}, momentum=0.9, wd={args.wd})")
@@ -112,12 +284,14 @@ def train_loop(args):
             sys.exit(1)
 
         # Load Weights
-        model.load_state_dict(torch.load(target_pth, map_location=device))
+        # Copied straight from the page cache into the params
+        model.load_state_dict(load_checkpoint(target_pth, mmap=True))
         print(f"[Python] LOADED: Weights from {target_pth}")
 
         # Load Optimizer
         if os.path.exists(target_opt):
-            optimizer.load_state_dict(torch.load(target_opt, map_location=device))
+            # Not mapped: CPU optimizer state is adopted as-is rather than copied
+            optimizer.load_state_dict(load_checkpoint(target_opt))
             print(f"[Python] Loaded optimizer state from {target_opt}")
 
             # Ensure that --lr and --wd command-line arguments take precedence over values stored in the saved optimizer state.
@@ -158,33 +332,78 @@ def train_loop(args):
     print(f"[Python] New Samples: {args.new_samples}, Sampling Rate: {args.sampling_rate}")
     print(f"[Python] Training for {num_steps} steps...")
 
+    if device.type == "cuda":
+        # Input shapes are fixed, so let cuDNN benchmark and cache the fastest conv algos
+        torch.backends.cudnn.benchmark = True
+
+    # Mixed precision: BF16 needs no loss scaling; FP16 uses a GradScaler
+    amp_dtype = resolve_amp_dtype(device, args.amp)
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+    if amp_dtype is not None:
+        print(f"[Python] Mixed precision: autocast to {amp_dtype}")
+
+    # Optional Inductor compilation. Specialized to the fixed training batch shape;
+    # the eager `model` is kept for checkpointing and ONNX export.
+    # The loss is compiled separately so Inductor fuses the softmax cross-entropy into one
+    # kernel instead of materializing the (batch, 4096) log-prob tensor.
+    train_model = model
+    loss_fn = compute_loss
+    if args.compile:
+        train_model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        loss_fn = torch.compile(compute_loss, fullgraph=True, dynamic=False)
+        print("[Python] Compiling model and loss with torch.compile (mode=reduce-overhead)")
+
     # Training
     model.train()
+    if args.gpu_buffer and device.type != "cpu":
+        # Batches are already on the device, so there is nothing to prefetch
+        buffer.to(device)
+        print(f"[Python] Replay buffer resident on {device}")
+        batches = (buffer.sample_batch(args.batch_size) for _ in range(num_steps))
+    else:
+        batches = BatchPrefetcher(buffer, args.batch_size, num_steps, device)
+    loss_sum = torch.zeros(3, device=device) # total, policy, value
+    logged_steps = 0
     for step in range(num_steps):
-        s, tp, tv = buffer.sample_batch(args.batch_size)
-        s, tp, tv = s.to(device), tp.to(device), tv.to(device)
+        s, tp, tv = next(batches)
+        # Compact buffer dtypes are widened to FP32 on the device, after the transfer
+        s, tp = s.float(), tp.float()
+        if channels_last:
+            s = s.contiguous(memory_format=torch.channels_last)
         
-        optimizer.zero_grad()
-        p, v = model(s)
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            p, v = train_model(s)
+            loss, loss_policy, loss_value = loss_fn(p, v, tp, tv)
         
-        # Explicit loss components
-        loss_policy = -torch.sum(tp * F.log_softmax(p, dim=1), dim=1).mean()
-        loss_value = F.mse_loss(v, tv)
-        loss = loss_policy + loss_value
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         
-        loss.backward()
-        optimizer.step()
+        # Accumulate on the device; .item() per step would stall the async pipeline
+        loss_sum += torch.stack([loss, loss_policy, loss_value]).detach()
         
-        # Individual component reporting for every step
-        print(f"  Step {step+1}/{num_steps}, Loss: {loss.item():.4f} "
-              f"(Policy: {loss_policy.item():.4f}, Value: {loss_value.item():.4f})")
+        # Individual component reporting, averaged over the interval
+        if (step + 1) % args.log_interval == 0 or step + 1 == num_steps:
+            avg_loss, avg_policy, avg_value = (loss_sum / (step + 1 - logged_steps)).tolist()
+            print(f"  Step {step+1}/{num_steps}, Loss: {avg_loss:.4f} "
+                  f"(Policy: {avg_policy:.4f}, Value: {avg_value:.4f})")
+            loss_sum.zero_()
+            logged_steps = step + 1
 
     # Save Checkpoint
     torch.save(model.state_dict(), model_pth)
     torch.save(optimizer.state_dict(), opt_pth)
-    export_to_onnx(model_pth, onnx_path)
+    # Export straight from the trained model; it already holds the saved weights
+    export_model_to_onnx(model, onnx_path)
     print(f"[Python] Training complete. Saved checkpoint to {args.save_dir}")
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {value}")
+    return n
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--save-dir", type=str, required=True)
@@ -196,4 +415,8 @@ if __name__ == "__main__":
     parser.add_argument("--lr", type=float, default=0.02)
     parser.add_argument("--wd", type=float, default=0.0001)
     parser.add_argument("--load-weights", type=str, default="")
+    parser.add_argument("--amp", type=str, default="bf16", choices=["none", "bf16", "fp16"])
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model for training")
+    parser.add_argument("--gpu-buffer", action="store_true", help="Keep the replay buffer in device memory")
+    parser.add_argument("--log-interval", type=positive_int, default=LOG_INTERVAL, help="Steps between loss reports")
     train_loop(args = parser.parse_args())
\ No newline at end of file